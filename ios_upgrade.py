@@ -1,10 +1,18 @@
-import getpass, re, time, datetime, yaml, socket, sys
+import getpass, re, time, datetime, yaml, socket, sys, json, os, sqlite3, threading
 
 from netmiko import ConnectHandler, NetMikoAuthenticationException, NetMikoTimeoutException
 from multiprocessing import Pool
 from contextlib import contextmanager
 from functools import partial
-from difflib import HtmlDiff
+from collections import OrderedDict, Mapping
+
+# the libyaml based loader is much faster on large inventories, fall back to the pure python loader if it isn't available
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+from difflib import unified_diff
+from cgi import escape
 
 # internally developed submodules
 from smtp_relay.smtp_relay import send_email
@@ -226,26 +234,98 @@ def reload_device(ssh_session, reload_verify):
     ssh_session.send_command_timing('')
 
 
-def set_boot_statement(ssh_session, boot_directory, image_name):
+class ConfigChangeSet(object):
+
+    '''
+        gathers every config change for a single device so they can be pushed in one config session
+        and saved once, rather than entering and leaving config mode for each change
+    '''
 
-    ''' sets the device boot statement '''
+    def __init__(self, hostname):
 
-    # clear the current boot variables
-    ssh_session.send_config_set('no boot system')
+        self.hostname = hostname
+        self.commands = []
 
-    # set the new boot variable
-    ssh_session.send_config_set('boot system ' + boot_directory + image_name)
+    def add(self, *commands):
+
+        self.commands.extend(commands)
+
+    def render(self):
+
+        ''' returns the change set as it would be entered in config mode '''
+
+        return '\n'.join(['! ' + self.hostname] + self.commands)
+
+    def apply(self, ssh_session):
+
+        ''' pushes all pending changes in a single config session, then saves the config '''
+
+        if not self.commands:
+
+            return
+
+        ssh_session.send_config_set(self.commands)
+
+        save_config(ssh_session)
+
+        self.commands = []
+
+
+def save_config(ssh_session):
+
+    ''' saves the running config '''
 
-    # save the config
     ssh_session.send_command_timing('copy run start')
     ssh_session.send_command('', expect_string='[OK]')
 
 
-def set_confreg(ssh_session):
+def set_boot_statement(change_set, boot_directory, image_name):
+
+    ''' adds the device boot statement to the change set '''
+
+    # clear the current boot variables
+    change_set.add('no boot system')
+
+    # set the new boot variable
+    change_set.add('boot system ' + boot_directory + image_name)
+
+
+def set_confreg(change_set):
+
+    ''' adds the configuration register to the change set '''
+
+    change_set.add('config-register 0x2102')
+
+
+def build_dry_run_change_set(device_settings):
+
+    ''' 
+        builds the change set for a device without connecting to it
+        values that depend on device facts are rendered as placeholders
+    '''
+
+    change_set = ConfigChangeSet(device_settings['hostname'])
+
+    if device_settings['fix_confreg']:
 
-    ''' sets the configuration register '''
+        change_set.add('! only if the current confreg is not one of ' + ', '.join(device_settings['confreg']))
+        set_confreg(change_set)
 
-    ssh_session.send_config_set('config 0x2102')
+    if device_settings['install']:
+
+        change_set.add('! only if the device is not running in install mode')
+        set_boot_statement(change_set, '<boot_directory>', device_settings['image_name'])
+
+    return change_set
+
+
+def dry_run(upgrade_settings):
+
+    ''' prints the change set for every device, nothing is pushed '''
+
+    for device_settings in upgrade_settings:
+
+        print_status(build_dry_run_change_set(device_settings).render() + '\n')
 
 
 def code_exists(ssh_session, image_name):
@@ -293,19 +373,19 @@ def email_builder(text):
     return '<p>' + text + '</p>'
 
 
-def validate_facts(ssh_session, facts, upgrade_settings):
+def validate_facts(facts, upgrade_settings, change_set):
 
     ''' 
         used to verify whether or not an upgrade will be successful based on confreg and running image values
-        doesn't return anything, but raises an exception if an error upon failure
+        required config fixes are added to change_set, raises an exception upon failure
     '''
 
     if facts['confreg'] not in upgrade_settings['confreg']:
 
         if(upgrade_settings['fix_confreg']):
 
-            set_confreg('ssh_session')
-            print_status(ssh_session.hostname + ': confreg updated')
+            set_confreg(change_set)
+            print_status(upgrade_settings['hostname'] + ': confreg will be updated')
         
         else:
 
@@ -319,17 +399,25 @@ def validate_facts(ssh_session, facts, upgrade_settings):
 def validate_intent(upgrade_settings, change_time):
 
     ''' validates that the YAML file is configured correctly based on user response '''
+
+    # group devices by mode and image so large inventories produce a short summary
+    device_counts = OrderedDict()
     
     for device_settings in upgrade_settings:
 
+        key = (device_settings['install'], device_settings['image_name'])
+        device_counts[key] = device_counts.get(key, 0) + 1
+
+    for (install, image_name), count in device_counts.items():
+
         # verify the current mode of the script
-        if device_settings['install']:
+        if install:
 
-            print 'This will INSTALL ' + device_settings['image_name'] + ' on ' + device_settings['hostname']
+            print 'This will INSTALL ' + image_name + ' on ' + str(count) + ' device(s)'
 
         else: 
 
-            print 'This will copy ' + device_settings['image_name'] + ' to ' + device_settings['hostname']
+            print 'This will copy ' + image_name + ' to ' + str(count) + ' device(s)'
 
     print '\nReload(s) will occur after ' + change_time.strftime('%c')
 
@@ -390,63 +478,208 @@ def get_validate_credentials(device):
     return username, password
 
 
-def make_facts_table(pre_facts, post_facts):
+class DeviceResult(object):
+
+    '''
+        compact per-device result record returned by the worker processes
 
-    ''' builds an html table containing our facts '''
+        phases is a list of (phase, status, elapsed seconds, error text) tuples, facts_delta maps
+        each fact that changed during the upgrade to a (pre, post) tuple and config_diff holds the
+        unified diff of the running config. Reports are rendered from this record in the parent.
+    '''
 
-    facts_table = '<table border="1"><tr><td></td>'
-    facts_table_pre = ''
-    facts_table_post = ''
+    __slots__ = ('hostname', 'phases', 'facts_delta', 'config_diff')
 
-    # create table heading
-    for key in pre_facts.keys():
+    def __init__(self, hostname):
 
-        if 'running_config' not in key:
+        self.hostname = hostname
+        self.phases = []
+        self.facts_delta = {}
+        self.config_diff = []
+
+    def __getstate__(self):
+
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+
+        for slot in self.__slots__:
+
+            setattr(self, slot, state[slot])
+
+    def add_phase(self, phase, status, start_time, error=None):
+
+        ''' records the outcome of a phase, elapsed time is measured from start_time '''
+
+        self.phases.append((phase, status, round(time.time() - start_time, 1), error))
+
+    def merge(self, other):
 
-            facts_table += '<td>' + key + '</td>'
+        ''' folds the phases and facts of another record for the same device into this one '''
+
+        self.phases.extend(other.phases)
+        self.facts_delta.update(other.facts_delta)
+        self.config_diff.extend(other.config_diff)
+
+    @classmethod
+    def from_dict(cls, result_dict):
+
+        ''' rebuilds a record from the output of to_dict '''
+
+        result = cls(result_dict['hostname'])
+        result.phases = [(phase['phase'], phase['status'], phase['elapsed'], phase['error']) 
+                            for phase in result_dict['phases']]
+        result.facts_delta = result_dict['facts_delta']
+        result.config_diff = result_dict['config_diff']
+
+        return result
+
+    def to_dict(self):
+
+        return {
+            'hostname': self.hostname,
+            'phases': [{'phase': phase, 'status': status, 'elapsed': elapsed, 'error': error} 
+                        for phase, status, elapsed, error in self.phases],
+            'facts_delta': self.facts_delta,
+            'config_diff': self.config_diff,
+        }
+
+
+def get_facts_delta(pre_facts, post_facts):
+
+    ''' returns a dict containing (pre, post) values for each fact that changed, the running config is diffed separately '''
+
+    facts_delta = {}
 
-    # add facts to the table
     for key in pre_facts:
 
         if 'running_config' not in key:
 
-            facts_table_pre += '<td>' + str(pre_facts[key]) + '</td>'
-            
-            # since keys may not match in both dicts in some edge cases we need to handle KeyErrors
-            try:
-
-                facts_table_post += '<td>' + str(post_facts[key]) + '</td>'
-            
-            except KeyError:
+            pre_value = str(pre_facts[key])
 
-                facts_table_post += '<td>NONE</td>'
-            
+            # since keys may not match in both dicts in some edge cases we need to handle missing keys
+            post_value = str(post_facts.get(key, 'NONE'))
 
-    facts_table += '<tr><td>pre-change</td>' + facts_table_pre + '</tr><tr><td>post-change</td>' + facts_table_post + '</tr></table>'
+            if pre_value != post_value:
 
-    return facts_table
+                facts_delta[key] = (pre_value, post_value)
 
+    return facts_delta
 
-def finalize_email(device, pre_facts, post_facts, email_body):
 
-    facts_table = make_facts_table(pre_facts, post_facts)
+def get_config_diff(pre_facts, post_facts):
 
-    email_body = '<h2>' + device + '</h2>' + email_body + facts_table + '<h3>Config changes</h3>'
+    ''' returns the unified diff of the pre and post change running config as a list of lines '''
 
-    
     try:
-        email_body += HtmlDiff().make_file(pre_facts['running_config'].splitlines(), 
-                                            post_facts['running_config'].splitlines(), 
-                                            context=True)
-    
-    # if a keyerror is encountered, post_facts may not have been gathered
+
+        return list(unified_diff(pre_facts['running_config'].splitlines(),
+                                post_facts['running_config'].splitlines(),
+                                'pre-change', 'post-change', lineterm=''))
+
+    # if a keyerror is encountered, the running config is missing from one of the fact dicts
     except KeyError:
 
-        return email_body
+        return []
+
+
+def merge_results(*result_lists):
+
+    ''' combines the records returned by each pool run into a single record per device, preserving device order '''
+
+    results = []
+    results_by_hostname = {}
+
+    for result_list in result_lists:
+
+        for result in result_list:
+
+            if result.hostname in results_by_hostname:
+
+                results_by_hostname[result.hostname].merge(result)
+
+            else:
+
+                results_by_hostname[result.hostname] = result
+                results.append(result)
+
+    return results
+
+
+def make_facts_table(facts_delta):
+
+    ''' builds an html table containing the facts that changed '''
+
+    facts_table = '<table border="1"><tr><td></td><td>pre-change</td><td>post-change</td></tr>'
+
+    for key in sorted(facts_delta):
+
+        pre_value, post_value = facts_delta[key]
+
+        facts_table += '<tr><td>' + key + '</td><td>' + escape(pre_value) + '</td><td>' + escape(post_value) + '</td></tr>'
+
+    facts_table += '</table>'
+
+    return facts_table
+
+
+def render_html(results):
+
+    ''' renders the email body for a list of device results '''
+
+    email_body = ''
+
+    for result in results:
+
+        email_body += '<h2>' + result.hostname + '</h2>'
+
+        for phase, status, elapsed, error in result.phases:
+
+            email_body += email_builder(phase + ': ' + status + ' (' + str(elapsed) + 's)')
+
+            if error:
+
+                email_body += email_builder(escape(error))
+
+        if result.facts_delta:
+
+            email_body += make_facts_table(result.facts_delta)
+
+        if result.config_diff:
+
+            email_body += '<h3>Config changes</h3><pre>' + escape('\n'.join(result.config_diff)) + '</pre>'
 
     return email_body
 
 
+def render_text(results):
+
+    ''' renders a plain text summary for a list of device results '''
+
+    lines = []
+
+    for result in results:
+
+        for phase, status, elapsed, error in result.phases:
+
+            line = result.hostname + ': ' + phase + ' ' + status + ' (' + str(elapsed) + 's)'
+
+            if error:
+
+                line += ' - ' + error
+
+            lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def render_json(results):
+
+    ''' renders a list of device results as json '''
+
+    return json.dumps([result.to_dict() for result in results], indent=2)
+
+
 def ssh_connect(device, username, password):
     
     ''' returns a netmiko ssh session '''
@@ -475,19 +708,21 @@ def ssh_reconnect(ssh_session):
 
 def validate_facts_copy_code(device_settings, username, password):
 
-    ''' copies code to a single device '''
-
-    # open an ssh session
-    ssh_session = ssh_connect(device_settings['hostname'], username, password)
-    pre_facts = get_facts(ssh_session)
+    ''' copies code to a single device, returns a DeviceResult '''
 
-    email_body = email_builder('copy code ' + device_settings['hostname'])
+    result = DeviceResult(device_settings['hostname'])
+    start_time = time.time()
 
     try:
 
+        # open an ssh session
+        ssh_session = ssh_connect(device_settings['hostname'], username, password)
+        pre_facts = get_facts(ssh_session)
+
         print_status(device_settings['hostname'] + ': validating device state')
 
-        validate_facts(ssh_session, pre_facts, device_settings)
+        # the change set is never applied here, every config change is pushed in a single session by upgrade_code
+        validate_facts(pre_facts, device_settings, ConfigChangeSet(device_settings['hostname']))
 
         print_status(device_settings['hostname'] + ': copying and verifying IOS image')
 
@@ -511,31 +746,50 @@ def validate_facts_copy_code(device_settings, username, password):
 
             print_status(device_settings['hostname'] + ': IOS image in slave flash and validated')
 
-        email_body += email_builder('Success')
+        result.add_phase('copy', 'success', start_time)
 
     except Exception as e:
         
         print_status(device_settings['hostname'] + ': ' + str(e))
-        email_body += email_builder(str(e))
+        result.add_phase('copy', 'failed', start_time, str(e))
 
     finally:
 
-        return email_body
+        return result
 
 
 def upgrade_code(device_settings, username, password):
 
-    ''' performs a code upgrade on a single device '''
+    ''' performs a code upgrade on a single device, returns a DeviceResult '''
 
-    # start the ssh session
-    ssh_session = ssh_connect(device_settings['hostname'], username, password)
-    pre_facts = get_facts(ssh_session)
+    result = DeviceResult(device_settings['hostname'])
+    start_time = time.time()
 
-    email_body = ''
+    ssh_session = None
+    pre_facts = None
+
+    status = 'success'
+    error = None
 
     try:
 
-        validate_facts(ssh_session, pre_facts, device_settings)
+        # start the ssh session
+        ssh_session = ssh_connect(device_settings['hostname'], username, password)
+        pre_facts = get_facts(ssh_session)
+
+        change_set = ConfigChangeSet(device_settings['hostname'])
+
+        validate_facts(pre_facts, device_settings, change_set)
+
+        # setting the boot statement works the same regardless of the number of SUPs, install mode uses software install instead
+        if device_settings['install'] and not pre_facts['install_mode']:
+
+            set_boot_statement(change_set, pre_facts['boot_directory'], device_settings['image_name'])
+
+        # push every config change in a single config session and save once
+        change_set.apply(ssh_session)
+
+        print_status(device_settings['hostname'] + ': config changes applied')
     
         # All the code below will cause an outage. Use caution to keep checks in place when restructuring
         if(device_settings['install']):
@@ -556,12 +810,6 @@ def upgrade_code(device_settings, username, password):
 
             else:
 
-                # setting the boot statement works the same regardless of the number of SUPs
-                set_boot_statement(ssh_session, pre_facts['boot_directory'], device_settings['image_name'])
-
-                print_status(device_settings['hostname'] + ': boot statement updated')
-
-
                 # single SUP devices
                 if pre_facts['number_sups'] < 2:
 
@@ -612,39 +860,89 @@ def upgrade_code(device_settings, username, password):
 
                 else:
 
-                    email_body += email_builder('device has more than 2 SUPs, not currently supported')
+                    status = 'unsupported'
+                    error = 'device has more than 2 SUPs, not currently supported'
 
  
     except Exception as e:
 
         print_status(device_settings['hostname'] + ': ' + str(e))
-        email_body += email_builder(str(e))
+        status = 'failed'
+        error = str(e)
 
     finally:
 
+        result.add_phase('upgrade', status, start_time, error)
+
+        # nothing to compare if the device could not be reached or pre change facts were not gathered
+        if ssh_session is None or pre_facts is None:
+
+            return result
+
+        post_facts_start_time = time.time()
+
         try:
             
             print_status(device_settings['hostname'] + ': gathering post change facts')
             post_facts = get_facts(ssh_session)
             print_status(device_settings['hostname'] + ': complete')
         
-        except Exception:
+        # without post change facts there is nothing to compare, record why instead
+        except Exception as e:
 
-            post_facts = {'error':'post change facts could not be gathered'}
-     
-        email_body = finalize_email(device_settings['hostname'], pre_facts, post_facts, email_body)
+            print_status(device_settings['hostname'] + ': ' + str(e))
+            result.add_phase('post_facts', 'failed', post_facts_start_time, 'post change facts could not be gathered: ' + str(e))
+
+            return result
+
+        result.facts_delta = get_facts_delta(pre_facts, post_facts)
+        result.config_diff = get_config_diff(pre_facts, post_facts)
         
-        return email_body
+        return result
+
+
+class DeviceSettings(Mapping):
+
+    ''' 
+        read only view of the device specific settings overlaid on the shared defaults
+        lookups fall through to the defaults, so the default dict is never copied per device
+    '''
+
+    def __init__(self, device, defaults):
+
+        self.device = device
+        self.defaults = defaults
+
+    def __getitem__(self, key):
+
+        if key in self.device:
+
+            return self.device[key]
+
+        return self.defaults[key]
+
+    def __iter__(self):
+
+        for key in self.device:
+
+            yield key
+
+        for key in self.defaults:
+
+            if key not in self.device:
+
+                yield key
+
+    def __len__(self):
+
+        return len(set(self.device) | set(self.defaults))
 
 
 def merge_settings(device, script_settings):
 
     ''' merges the default and device specific dictionaries '''
 
-    upgrade_settings = script_settings['default'].copy()
-    upgrade_settings.update(device)
-
-    return upgrade_settings
+    return DeviceSettings(device, script_settings['default'])
 
 
 def set_upgrade_settings(script_settings):
@@ -660,6 +958,15 @@ def set_upgrade_settings(script_settings):
     return upgrade_settings
 
 
+def load_script_settings(settings_file):
+
+    ''' parses the config file '''
+
+    with open(settings_file) as settings:
+
+        return yaml.load(settings, Loader=SafeLoader)
+
+
 def print_status(status):
 
     ''' 
@@ -673,10 +980,367 @@ def print_status(status):
     except:
         pass
 
+def run_upgrades(upgrade_settings, threads, pre_copy, change_time, username, password):
+
+    ''' copies code to and upgrades a list of devices, returns a DeviceResult per device '''
+
+    # copy code to devices
+    if pre_copy:
+
+        print_status('Copying code prior to change window')
+
+        with poolcontext(processes=threads) as pool:
+
+            copy_results = pool.map(partial(validate_facts_copy_code,
+                                            username=username,
+                                            password=password),
+                                upgrade_settings)
+
+    else:
+
+        wait_for_change_window(change_time)
+
+        with poolcontext(processes=threads) as pool:
+
+            copy_results = pool.map(partial(validate_facts_copy_code,
+                                            username=username,
+                                            password=password),
+                                upgrade_settings)
+
+    with poolcontext(processes=threads) as pool:
+
+        upgrade_results = pool.map(partial(upgrade_code, 
+                                        username=username, 
+                                        password=password), 
+                                upgrade_settings)
+
+    # workers only return compact records, all report views are rendered by the caller
+    return merge_results(copy_results, upgrade_results)
+
+
+# workers update the heartbeat of their claimed shard this often (in seconds)
+HEARTBEAT_INTERVAL = 60
+
+# a claimed shard without a heartbeat for this long (in seconds) is assumed to be abandoned and may be claimed again
+HEARTBEAT_TIMEOUT = 600
+
+
+def create_queue_tables(connection):
+
+    ''' creates the queue tables if they don't already exist '''
+
+    with connection:
+
+        connection.execute('''CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)''')
+        connection.execute('''CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, site TEXT, devices TEXT, 
+                                status TEXT, worker TEXT, claimed_at REAL, heartbeat REAL, results TEXT, error TEXT)''')
+
+
+def open_queue(queue_file):
+
+    ''' opens the sqlite shard queue shared by the coordinator and workers, creating the tables if needed '''
+
+    # a generous timeout since several workers may be writing to the queue at the same time
+    connection = sqlite3.connect(queue_file, timeout=60)
+
+    create_queue_tables(connection)
+
+    return connection
+
+
+def shard_by_site(upgrade_settings):
+
+    ''' splits the device list into shards by site, devices without a site are placed in the default shard '''
+
+    shards = OrderedDict()
+
+    for device_settings in upgrade_settings:
+
+        shards.setdefault(device_settings.get('site') or 'default', []).append(device_settings)
+
+    return shards
+
+
+def enqueue_shards(connection, script_settings, change_time, upgrade_settings):
+
+    ''' replaces the contents of the queue with a shard per site and the settings workers need to run them '''
+
+    worker_settings = {
+        'threads': script_settings['threads'],
+        'pre_copy': script_settings['pre_copy'],
+        'change_time': time.mktime(change_time.timetuple()),
+    }
+
+    # the queue is rebuilt from scratch so a queue file left by an older run can't leave stale shards or columns behind
+    with connection:
+
+        connection.execute('DROP TABLE IF EXISTS settings')
+        connection.execute('DROP TABLE IF EXISTS shards')
+
+    create_queue_tables(connection)
+
+    with connection:
+
+        connection.execute('INSERT INTO settings (name, value) VALUES (?, ?)', ('worker_settings', json.dumps(worker_settings)))
+
+        for site, devices in shard_by_site(upgrade_settings).items():
+
+            connection.execute("INSERT INTO shards (site, devices, status) VALUES (?, ?, 'pending')", (site, json.dumps([dict(device_settings) for device_settings in devices])))
+
+
+def claim_shard(connection, worker):
+
+    ''' 
+        claims the next pending shard for this worker, returns None once the queue is empty
+        shards claimed by a worker that stopped sending heartbeats are claimed again
+    '''
+
+    now = time.time()
+
+    # the update is a single statement, so two workers can never claim the same shard
+    with connection:
+
+        cursor = connection.execute('''UPDATE shards SET status = 'claimed', worker = ?, claimed_at = ?, heartbeat = ?
+                                        WHERE id = (SELECT id FROM shards 
+                                                    WHERE status = 'pending' OR (status = 'claimed' AND heartbeat < ?) 
+                                                    ORDER BY id LIMIT 1)''', 
+                                    (worker, now, now, now - HEARTBEAT_TIMEOUT))
+
+    if cursor.rowcount == 0:
+
+        return None
+
+    shard_id, site, devices = connection.execute("SELECT id, site, devices FROM shards WHERE status = 'claimed' AND worker = ?", 
+                                                    (worker,)).fetchone()
+
+    return shard_id, site, json.loads(devices)
+
+
+def start_heartbeat(queue_file, shard_id, worker):
+
+    ''' updates the heartbeat of a claimed shard from a background thread until the returned event is set '''
+
+    stop = threading.Event()
+
+    def heartbeat():
+
+        # sqlite connections can't be shared between threads
+        connection = sqlite3.connect(queue_file, timeout=60)
+
+        while not stop.wait(HEARTBEAT_INTERVAL):
+
+            try:
+
+                with connection:
+
+                    connection.execute('UPDATE shards SET heartbeat = ? WHERE id = ? AND worker = ?', (time.time(), shard_id, worker))
+
+            # a busy or briefly unreachable queue file is retried on the next interval
+            except sqlite3.Error:
+
+                pass
+
+        connection.close()
+
+    heartbeat_thread = threading.Thread(target=heartbeat)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    return stop
+
+
+def complete_shard(connection, shard_id, worker, results=None, error=None):
+
+    ''' 
+        reports the results of a shard back to the coordinator, a shard with an error is marked failed
+        nothing is written if the shard was claimed by another worker or failed by the coordinator in the meantime
+    '''
+
+    if error is None:
+
+        status = 'done'
+        results = json.dumps([result.to_dict() for result in results])
+
+    else:
+
+        status = 'failed'
+
+    with connection:
+
+        connection.execute('''UPDATE shards SET status = ?, results = ?, error = ? 
+                                WHERE id = ? AND worker = ? AND status = 'claimed' ''', 
+                            (status, results, error, shard_id, worker))
+
+
+def wait_for_shards(connection, deadline):
+
+    ''' 
+        loops until every shard has been completed by a worker, sleeping for 30 seconds between iterations
+        shards that are still unfinished after the deadline are marked failed
+    '''
+
+    last_counts = None
+
+    while True:
+
+        if time.time() > deadline:
+
+            with connection:
+
+                connection.execute('''UPDATE shards SET status = 'failed', error = 'shard did not complete before the deadline' 
+                                        WHERE status IN ('pending', 'claimed')''')
+
+            print_status('deadline reached, unfinished shards marked failed')
+
+            break
+
+        counts = dict(connection.execute('SELECT status, COUNT(*) FROM shards GROUP BY status').fetchall())
+
+        if counts != last_counts:
+
+            print_status('shards: ' + ', '.join(status + ' ' + str(count) for status, count in sorted(counts.items())))
+            last_counts = counts
+
+        if not counts.get('pending') and not counts.get('claimed'):
+
+            break
+
+        time.sleep(30)
+
+
+def collect_results(connection):
+
+    ''' builds a single list of device results from every shard, devices in a failed shard get a failed shard phase '''
+
+    results = []
+
+    for site, devices, status, worker, shard_results, error in connection.execute(
+            'SELECT site, devices, status, worker, results, error FROM shards ORDER BY id'):
+
+        if status == 'done':
+
+            results.extend(DeviceResult.from_dict(result_dict) for result_dict in json.loads(shard_results))
+
+        else:
+
+            for device_settings in json.loads(devices):
+
+                result = DeviceResult(device_settings['hostname'])
+                result.phases.append(('shard', status, 0, 'shard ' + site + ' failed on ' + str(worker) + ': ' + str(error)))
+                results.append(result)
+
+    return results
+
+
+def run_coordinator(queue_file, script_settings, change_time, upgrade_settings):
+
+    ''' queues a shard per site, waits for the workers to finish them and returns the combined results '''
+
+    connection = open_queue(queue_file)
+
+    enqueue_shards(connection, script_settings, change_time, upgrade_settings)
+
+    print_status('Queued ' + str(len(upgrade_settings)) + ' devices in ' + queue_file + ', start workers with: ios_upgrade.py worker ' + queue_file)
+
+    # allow every device its full reload time after the change window, even if the shards end up running one after another
+    deadline = max(time.mktime(change_time.timetuple()), time.time())
+    deadline += sum(device_settings['reload_max_time'] for device_settings in upgrade_settings)
+
+    wait_for_shards(connection, deadline)
+
+    results = collect_results(connection)
+
+    connection.close()
+
+    return results
+
+
+def run_worker(queue_file):
+
+    ''' pulls shards from the queue and upgrades their devices until the queue is empty '''
+
+    connection = open_queue(queue_file)
+
+    worker = socket.gethostname() + ':' + str(os.getpid())
+
+    worker_settings = json.loads(connection.execute("SELECT value FROM settings WHERE name = 'worker_settings'").fetchone()[0])
+    change_time = datetime.datetime.fromtimestamp(worker_settings['change_time'])
+
+    username = password = None
+
+    while True:
+
+        shard = claim_shard(connection, worker)
+
+        if shard is None:
+
+            break
+
+        shard_id, site, upgrade_settings = shard
+
+        print_status(worker + ': claimed shard ' + site + ' (' + str(len(upgrade_settings)) + ' devices)')
+
+        heartbeat = start_heartbeat(queue_file, shard_id, worker)
+
+        results = None
+
+        # overwritten once the shard completes, so an interrupted worker (ie. CTRL + C) still reports the shard as failed
+        error = 'worker stopped before the shard completed'
+
+        try:
+
+            # credentials are only requested once a shard has been claimed, they are never written to the queue
+            if username is None:
+
+                username, password = get_validate_credentials(upgrade_settings[0]['hostname'])
+
+            results = run_upgrades(upgrade_settings,
+                                    worker_settings['threads'],
+                                    worker_settings['pre_copy'],
+                                    change_time,
+                                    username,
+                                    password)
+
+            error = None
+
+            print_status(worker + ': shard ' + site + ' complete')
+
+        except Exception as e:
+
+            error = str(e)
+
+            print_status(worker + ': shard ' + site + ' failed: ' + error)
+
+        finally:
+
+            heartbeat.set()
+
+            complete_shard(connection, shard_id, worker, results=results, error=error)
+
+    print_status(worker + ': no shards left in the queue')
+
+    connection.close()
+
+
 def main():
 
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+
+    # anything unexpected exits here, a mistyped mode must never fall through to a local upgrade
+    if mode not in (None, 'coordinator', 'worker') or (mode is not None and len(sys.argv) != 3):
+
+        print_status('usage: ios_upgrade.py [coordinator <queue_file> | worker <queue_file>]')
+
+        exit(1)
+
+    if mode == 'worker':
+
+        run_worker(sys.argv[2])
+
+        exit()
+
     # pull data from config file
-    script_settings = yaml.safe_load(open("ios_upgrade.yml"))
+    script_settings = load_script_settings("ios_upgrade.yml")
 
     start_time = time.time()
 
@@ -688,47 +1352,44 @@ def main():
 
     upgrade_settings = set_upgrade_settings(script_settings)
 
-    # verify that the YAML actually contains what we want to do
-    if not validate_intent(upgrade_settings, change_time):
+    # render the config changes for every device without connecting
+    if script_settings.get('dry_run'):
 
-        exit()
+        dry_run(upgrade_settings)
 
-    # attempt to get the username from environment variables, prompt if needed
-    username, password = get_validate_credentials(upgrade_settings[0]['hostname'])
+        exit()
 
-    # copy code to devices
-    if script_settings['pre_copy']:
+    # verify that the YAML actually contains what we want to do
+    if not validate_intent(upgrade_settings, change_time):
 
-        print_status('Copying code prior to change window')
+        exit()
 
-        with poolcontext(processes=script_settings['threads']) as pool:
+    if mode == 'coordinator':
 
-            upgrade_html = pool.map(partial(validate_facts_copy_code,
-                                            username=username,
-                                            password=password),
-                                upgrade_settings)
+        # workers on other hosts do the upgrades, the coordinator only builds the final report
+        results = run_coordinator(sys.argv[2], script_settings, change_time, upgrade_settings)
 
     else:
 
-        wait_for_change_window(change_time)
+        # attempt to get the username from environment variables, prompt if needed
+        username, password = get_validate_credentials(upgrade_settings[0]['hostname'])
 
-        with poolcontext(processes=script_settings['threads']) as pool:
+        results = run_upgrades(upgrade_settings,
+                                script_settings['threads'],
+                                script_settings['pre_copy'],
+                                change_time,
+                                username,
+                                password)
 
-            upgrade_html = pool.map(partial(validate_facts_copy_code,
-                                            username=username,
-                                            password=password),
-                                upgrade_settings)
+    print_status(render_text(results))
 
-    with poolcontext(processes=script_settings['threads']) as pool:
+    if script_settings.get('report_file'):
 
-        upgrade_html = pool.map(partial(upgrade_code, 
-                                        username=username, 
-                                        password=password), 
-                                upgrade_settings)
+        with open(script_settings['report_file'], 'w') as report_file:
 
-    for html in upgrade_html:
+            report_file.write(render_json(results))
 
-        email_body += html
+    email_body += render_html(results)
 
     total_time = time.time() - start_time
     total_time = time.strftime('%H:%M:%S', time.gmtime(total_time))